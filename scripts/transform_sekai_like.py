@@ -1,20 +1,27 @@
 import asyncio
+import hashlib
 import math
+import os
+import string
 import sys
 import traceback
+from collections import Counter
+from collections.abc import Callable
 from dataclasses import dataclass
+from functools import cache
 from pathlib import Path
-from typing import Callable, Optional, TypeVar, Union
-from typing_extensions import ParamSpec, TypeAlias
+from typing import ParamSpec, TypeAlias, TypeVar
+from urllib.parse import quote, unquote, urlsplit
 
+import orjson
 from cookit import with_semaphore
-from cookit.pyd import CamelAliasModel, type_validate_json
-from httpx import AsyncClient
+from cookit.pyd import CamelAliasModel, type_dump_python, type_validate_json
+from httpx import AsyncClient, HTTPStatusError, Limits, TransportError
 from nonebot_plugin_meme_stickers.consts import (
+    CHECKSUM_FILENAME,
     MANIFEST_FILENAME,
     RGBAColorTuple,
 )
-from nonebot_plugin_meme_stickers.scripts.gen_checksum import calc_n_write_checksum
 from nonebot_plugin_meme_stickers.sticker_pack.models import (
     StickerGridSetting,
     StickerInfoOptionalParams,
@@ -22,13 +29,11 @@ from nonebot_plugin_meme_stickers.sticker_pack.models import (
     StickerPackManifest,
     StickerParamsOptional,
 )
-from nonebot_plugin_meme_stickers.utils import (
-    dump_readable_model,
-    op_retry,
-)
-from pydantic import BaseModel
-from rich.progress import Progress
-from yarl import URL
+from nonebot_plugin_meme_stickers.sticker_pack.update import collect_manifest_files
+from nonebot_plugin_meme_stickers.utils import op_retry
+from pydantic import BaseModel, Field, TypeAdapter
+from rich.progress import Progress, TaskID
+from tenacity import retry_if_exception_type, wait_random_exponential
 
 
 class CharacterDefaultText(BaseModel):
@@ -41,8 +46,8 @@ class CharacterDefaultText(BaseModel):
 
 class SekaiCharacter(CamelAliasModel):
     id: str
-    name: str
-    character: str
+    name: str = Field(min_length=1)
+    character: str = Field(min_length=1)
     img: str
     color: str
     default_text: CharacterDefaultText
@@ -50,16 +55,20 @@ class SekaiCharacter(CamelAliasModel):
 
 class ArcaeaCharacter(CamelAliasModel):
     id: str
-    name: str
-    character: str
+    name: str = Field(min_length=1)
+    character: str = Field(min_length=1)
     img: str
     fill_color: str
     stroke_color: str
     default_text: CharacterDefaultText
 
 
-Character: TypeAlias = Union[SekaiCharacter, ArcaeaCharacter]
-Characters: TypeAlias = Union[list[SekaiCharacter], list[ArcaeaCharacter]]
+Character: TypeAlias = SekaiCharacter | ArcaeaCharacter
+Characters: TypeAlias = list[SekaiCharacter] | list[ArcaeaCharacter]
+
+CHARACTERS_ADAPTERS: dict[type[Character], TypeAdapter[Characters]] = {
+    cls: TypeAdapter(list[cls]) for cls in (SekaiCharacter, ArcaeaCharacter)
+}
 
 P = ParamSpec("P")
 R = TypeVar("R")
@@ -69,64 +78,150 @@ ResDownloadFinishCallback: TypeAlias = Callable[[str], None]
 
 CharsGotCallback: TypeAlias = Callable[[Characters], None]
 
+DOWNLOAD_CHUNK_SIZE = 65536
+MAX_CONNECTIONS = 32
+PROGRESS_UPDATE_INTERVAL = 0.05
+URL_PATH_SAFE_CHARS = "/!$&'()*+,;=:@~"
+"""chars left unescaped in image url paths, same as yarl does when joining paths"""
 
+
+@cache
 def normalize_character_name(name: str) -> str:
     return f"{name[0].upper()}{name[1:]}"
 
 
+@cache
+def _to_local_path(character: str, img: str) -> str:
+    name = unquote(urlsplit(img).path.rsplit("/", 1)[-1])
+    return f"{normalize_character_name(character)}/{name}"
+
+
 def to_local_path(char: Character) -> str:
-    return f"{normalize_character_name(char.character)}/{URL(char.img).name}"
+    return _to_local_path(char.character, char.img)
+
+
+def calc_file_checksum(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def http_retry():
+    # jittered backoff, so parallel downloads failing together won't retry in sync
+    return op_retry(
+        wait=wait_random_exponential(multiplier=0.2, max=5),
+        retry=retry_if_exception_type((TransportError, HTTPStatusError)),
+    )
 
 
 def create_sem() -> asyncio.Semaphore:
-    return asyncio.Semaphore(8)
+    return asyncio.Semaphore(MAX_CONNECTIONS)
+
+
+def create_client() -> AsyncClient:
+    return AsyncClient(
+        http2=True,
+        limits=Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_CONNECTIONS,
+        ),
+        timeout=30.0,
+    )
 
 
 async def prepare_resources(
+    cli: AsyncClient,
     chars: Characters,
-    res_base_url: URL,
+    res_base_url: str,
     download_path: Path,
+    known_checksums: dict[str, str],
     sem: asyncio.Semaphore,
     finish_callback: ResDownloadFinishCallback,
-) -> list[str]:
+) -> dict[str, str]:
     """return map of file path and sha256 hashes"""
 
-    @with_semaphore(sem)
-    @op_retry()
-    async def download_task(cli: AsyncClient, char: Character) -> str:
-        """return checksum"""
-        url = res_base_url / char.img
-        async with cli.stream("GET", str(url)) as resp:
-            resp.raise_for_status()
-            content = await resp.aread()
+    res_base_url = res_base_url.rstrip("/")
 
+    @with_semaphore(sem)
+    @http_retry()
+    async def download_task(cli: AsyncClient, char: Character) -> tuple[str, str]:
+        """return path and checksum"""
+        url = f"{res_base_url}/{quote(char.img.lstrip('/'), safe=URL_PATH_SAFE_CHARS)}"
         relative_path = to_local_path(char)
-        file_path = download_path / to_local_path(char)
+        file_path = download_path / relative_path
         file_path.parent.mkdir(parents=True, exist_ok=True)
-        file_path.write_bytes(content)
+
+        # only revalidate against upstream when local file is still intact
+        headers: dict[str, str] = {}
+        if (
+            (known := known_checksums.get(relative_path))
+            and file_path.exists()
+            and (await asyncio.to_thread(calc_file_checksum, file_path)) == known
+        ):
+            headers["If-None-Match"] = f'"{known}"'
+
+        sha256 = hashlib.sha256()
+        async with cli.stream("GET", url, headers=headers) as resp:
+            if resp.status_code == 304 and known:
+                finish_callback(relative_path)
+                return relative_path, known
+
+            resp.raise_for_status()
+            # keep the old file intact until the whole body has arrived
+            temp_path = to_temp_path(file_path)
+            try:
+                with temp_path.open("wb") as f:
+                    async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        sha256.update(chunk)
+                        f.write(chunk)
+            except BaseException:  # also when cancelled by a failed sibling task
+                temp_path.unlink(missing_ok=True)
+                raise
+            os.replace(temp_path, file_path)
 
         finish_callback(relative_path)
-        return relative_path
+        return relative_path, sha256.hexdigest()
+
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(download_task(cli, c)) for c in chars]
+    return dict(t.result() for t in tasks)
 
-    async with AsyncClient() as cli:
-        return await asyncio.gather(*(download_task(cli, c) for c in chars))
 
+HEX_COLOR_EXPANDERS: dict[int, Callable[[str], str]] = {
+    3: lambda c: f"{c[0] * 2}{c[1] * 2}{c[2] * 2}FF",  # RGB
+    4: lambda c: f"{c[1] * 2}{c[2] * 2}{c[3] * 2}{c[0] * 2}",  # ARGB
+    6: lambda c: f"{c}FF",  # RRGGBB
+    8: lambda c: f"{c[2:]}{c[:2]}",  # AARRGGBB
+}
+"""color length -> function expanding it to RRGGBBAA"""
 
+HEX_DIGITS = frozenset(string.hexdigits)
+
+
+@cache
 def web_hex_to_color_tuple(color: str) -> RGBAColorTuple:
-    color = color.upper().removeprefix("#")
-
-    if len(color) == 3:
-        color = "".join((*(c * 2 for c in color), "FF"))
-    elif len(color) == 4:
-        color = "".join((*(c * 2 for c in color[1:]), color[0] * 2))
-    elif len(color) == 6:
-        color = f"{color}FF"
-    elif len(color) == 8:
-        color = f"{color[2:]}{color[:2]}"
-    else:
+    color = color.removeprefix("#")
+    # int() alone would also accept things like "0x", "_" and signs
+    if not (
+        (expander := HEX_COLOR_EXPANDERS.get(len(color)))
+        and HEX_DIGITS.issuperset(color)
+    ):
         raise ValueError("Invalid color format")
 
-    return tuple(int(color[i : i + 2], 16) for i in range(0, 8, 2))  # type: ignore
+    value = int(expander(color), 16)
+    return (value >> 24, (value >> 16) & 0xFF, (value >> 8) & 0xFF, value & 0xFF)
+
+
+def to_temp_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.tmp")
+
+
+def write_readable_model(path: Path, data: object, **type_dump_kw) -> None:
+    path.write_bytes(
+        orjson.dumps(
+            type_dump_python(data, **type_dump_kw),
+            option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE,
+        ),
+    )
 
 
 WIDTH = 296
@@ -137,8 +232,23 @@ STROKE_FACTOR = 9 / 38
 
 async def transform_manifest(
     chars: Characters,
-    base_manifest: Optional[StickerPackManifest] = None,
+    base_manifest: StickerPackManifest | None = None,
 ) -> StickerPackManifest:
+    # compute derived values column by column before building the models
+    text_rotates = [math.degrees(c.default_text.r / 10) for c in chars]
+    text_colors = [
+        web_hex_to_color_tuple(
+            c.color if isinstance(c, SekaiCharacter) else c.fill_color,
+        )
+        for c in chars
+    ]
+    stroke_colors = [
+        web_hex_to_color_tuple(c.stroke_color)
+        if isinstance(c, ArcaeaCharacter)
+        else None
+        for c in chars
+    ]
+
     return StickerPackManifest(
         version=(
             base_manifest.version  # + 1
@@ -170,35 +280,38 @@ async def transform_manifest(
         ),
         sample_sticker=base_manifest.sample_sticker if base_manifest else None,
         external_fonts=base_manifest.external_fonts if base_manifest else [],
+        # values below come from validated characters, skip re-validating them,
+        # but keep the float coercion validation would have done;
+        # non-empty name and category are ensured by the character models
         stickers=[
-            StickerInfoOptionalParams(
+            StickerInfoOptionalParams.model_construct(
                 name=char.name,
                 category=normalize_character_name(char.character),
-                params=StickerParamsOptional(
+                params=StickerParamsOptional.model_construct(
                     base_image=to_local_path(char),
                     text=char.default_text.text,
-                    text_x=char.default_text.x,
-                    text_y=char.default_text.y,
-                    text_rotate_degrees=math.degrees(char.default_text.r / 10),
-                    text_color=(
-                        web_hex_to_color_tuple(char.color)
-                        if isinstance(char, SekaiCharacter)
-                        else web_hex_to_color_tuple(char.fill_color)
-                    ),
-                    stroke_color=(
-                        web_hex_to_color_tuple(char.stroke_color)
-                        if isinstance(char, ArcaeaCharacter)
-                        else None
-                    ),
-                    font_size=char.default_text.s,
+                    text_x=float(char.default_text.x),
+                    text_y=float(char.default_text.y),
+                    text_rotate_degrees=text_rotate,
+                    text_color=text_color,
+                    stroke_color=stroke_color,
+                    font_size=float(char.default_text.s),
                 ),
             )
-            for char in chars
+            for char, text_rotate, text_color, stroke_color in zip(
+                chars,
+                text_rotates,
+                text_colors,
+                stroke_colors,
+            )
         ],
     )
 
 
 async def transform_sekai_like(
+    cli: AsyncClient,
+    sem: asyncio.Semaphore,
+    character_cls: type[Character],
     characters_json_url: str,
     res_base_url: str,
     target_path: Path,
@@ -207,35 +320,71 @@ async def transform_sekai_like(
 ):
     manifest_path = target_path / MANIFEST_FILENAME
     original_manifest = (
-        type_validate_json(StickerPackManifest, manifest_path.read_text("u8"))
+        type_validate_json(StickerPackManifest, manifest_path.read_bytes())
         if manifest_path.exists()
         else None
     )
+    checksum_path = target_path / CHECKSUM_FILENAME
+    original_checksum = (
+        type_validate_json(dict[str, str], checksum_path.read_bytes())
+        if checksum_path.exists()
+        else {}
+    )
 
-    async with AsyncClient() as cli:
-        chars = type_validate_json(
-            Characters,
-            ((await op_retry()(cli.get)(characters_json_url)).raise_for_status().text),
-        )
+    @http_retry()
+    async def fetch_characters() -> bytes:
+        return (await cli.get(characters_json_url)).raise_for_status().content
+
+    chars = CHARACTERS_ADAPTERS[character_cls].validate_json(await fetch_characters())
     chars_got_callback(chars)
 
-    sem = create_sem()
-    res_base_url_obj = URL(res_base_url)
-    await prepare_resources(
+    checksum = await prepare_resources(
+        cli,
         chars,
-        res_base_url_obj,
+        res_base_url,
         target_path,
+        original_checksum,
         sem,
         finish_callback,
     )
 
     new_manifest = await transform_manifest(chars, original_manifest)
-    manifest_path.write_text(
-        dump_readable_model(new_manifest, exclude_unset=True, exclude_defaults=True),
-        "u8",
+
+    # downloaded files are hashed while streaming, only hash the rest here
+    rest_files = [f for f in collect_manifest_files(new_manifest) if f not in checksum]
+    rest_checksums = await asyncio.gather(
+        *(asyncio.to_thread(calc_file_checksum, target_path / f) for f in rest_files),
     )
+    checksum.update(zip(rest_files, rest_checksums))
+    checksum = dict(sorted(checksum.items(), key=lambda x: x[0].split("/")))
+
+    manifest_temp_path = to_temp_path(manifest_path)
+    checksum_temp_path = to_temp_path(checksum_path)
+    try:
+        # wait for both writes to settle, so no thread recreates a removed temp file
+        results = await asyncio.gather(
+            asyncio.to_thread(
+                write_readable_model,
+                manifest_temp_path,
+                new_manifest,
+                exclude_unset=True,
+                exclude_defaults=True,
+            ),
+            asyncio.to_thread(write_readable_model, checksum_temp_path, checksum),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+    except BaseException:
+        manifest_temp_path.unlink(missing_ok=True)
+        checksum_temp_path.unlink(missing_ok=True)
+        raise
 
-    calc_n_write_checksum(target_path, new_manifest)
+    # swap in only after both are fully written; this narrows the window where
+    # the pair can mismatch, but the two replaces are still separate (and unsynced)
+    os.replace(manifest_temp_path, manifest_path)
+    os.replace(checksum_temp_path, checksum_path)
 
 
 @dataclass
@@ -243,6 +392,7 @@ class TransformTaskConfig:
     name: str
     characters_json_url: str
     res_base_url: str
+    character_cls: type[Character]
 
 
 async def _main() -> int:
@@ -259,6 +409,7 @@ async def _main() -> int:
                 "https://raw.githubusercontent.com/TheOriginalAyaka/sekai-stickers"
                 "/refs/heads/main/public/img"
             ),
+            SekaiCharacter,
         ),
         TransformTaskConfig(
             "arcaea",
@@ -270,6 +421,7 @@ async def _main() -> int:
                 "https://raw.githubusercontent.com/Rosemoe/arcaea-stickers"
                 "/refs/heads/main/public/img"
             ),
+            ArcaeaCharacter,
         ),
     ]
 
@@ -278,10 +430,36 @@ async def _main() -> int:
         "[yellow]{task.completed}/{task.total}",
     )
 
-    async def transform_task(cfg: TransformTaskConfig):
+    # downloads only enqueue (task_id, description),
+    # progress bar gets updated in batches by `progress_updater`
+    progress_queue: asyncio.Queue[tuple[TaskID, str]] = asyncio.Queue()
+
+    def flush_progress():
+        advances: Counter[TaskID] = Counter()
+        descriptions: dict[TaskID, str] = {}
+        while not progress_queue.empty():
+            task_id, description = progress_queue.get_nowait()
+            advances[task_id] += 1
+            descriptions[task_id] = description
+        for task_id, advance in advances.items():
+            progress.update(task_id, description=descriptions[task_id], advance=advance)
+
+    async def progress_updater():
+        while True:
+            await asyncio.sleep(PROGRESS_UPDATE_INTERVAL)
+            flush_progress()
+
+    async def transform_task(
+        cli: AsyncClient,
+        sem: asyncio.Semaphore,
+        cfg: TransformTaskConfig,
+    ):
         task_id = progress.add_task(cfg.name, start=False, total=0)
         try:
             await transform_sekai_like(
+                cli,
+                sem,
+                cfg.character_cls,
                 cfg.characters_json_url,
                 cfg.res_base_url,
                 root_path / cfg.name,
@@ -289,28 +467,41 @@ async def _main() -> int:
                     progress.update(task_id, total=len(chars))
                     or progress.start_task(task_id)
                 ),
-                lambda path: progress.update(
-                    task_id,
-                    description=f"{cfg.name}: {path}",
-                    advance=1,
+                lambda path: progress_queue.put_nowait(
+                    (task_id, f"{cfg.name}: {path}"),
                 ),
             )
         except Exception:
             traceback.print_exc()
+            flush_progress()
             progress.update(task_id, description=f"{cfg.name}: Error")
             raise
+        flush_progress()
         progress.stop_task(task_id)
 
-    with progress:
-        excs = await asyncio.gather(
-            *(transform_task(cfg) for cfg in task_configs),
-            return_exceptions=True,
-        )
-        if any(excs):
-            return 1
+    # both packs are fetched from the same host, so they share one limit
+    sem = create_sem()
+    async with create_client() as cli:
+        with progress:
+            updater = asyncio.create_task(progress_updater())
+            excs = await asyncio.gather(
+                *(transform_task(cli, sem, cfg) for cfg in task_configs),
+                return_exceptions=True,
+            )
+            updater.cancel()
+            if any(excs):
+                return 1
 
     return 0
 
 
 def main():
-    sys.exit(asyncio.run(_main()))
+    try:
+        import uvloop
+    except ImportError:  # not available on Windows
+        loop_factory = None
+    else:
+        loop_factory = uvloop.new_event_loop
+
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        sys.exit(runner.run(_main()))